@@ -1,16 +1,22 @@
 from google.cloud import vision
+from functools import lru_cache
 import io
+import os
 import re
 
-# Đường dẫn đến file key JSON của bạn
-client = vision.ImageAnnotatorClient.from_service_account_file("service_account.json")
+@lru_cache(maxsize=None)
+def get_client():
+    # Đường dẫn đến file key JSON của bạn (chỉ khởi tạo khi cần)
+    return vision.ImageAnnotatorClient.from_service_account_file(
+        os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "service_account.json")
+    )
 
 def ocr_id_card(image_path):
     with io.open(image_path, 'rb') as image_file:
         content = image_file.read()
 
     image = vision.Image(content=content)
-    response = client.text_detection(image=image)
+    response = get_client().text_detection(image=image)
     texts = response.text_annotations
 
     if not texts:
@@ -20,6 +26,6 @@ def ocr_id_card(image_path):
     return full_text
 
 # # Test
-text = ocr_id_card("id_card.jpg")
-print(text) 
-
+if __name__ == "__main__":
+    text = ocr_id_card("id_card.jpg")
+    print(text)
@@ -1,19 +1,47 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
-import requests
-import json
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from PIL import Image, ImageOps
+import httpx
+import orjson
 import openai
 import re
 import logging
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
 import asyncio
+import base64
+import hashlib
+import io
 import os
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Vietnamese ID Card and Vehicle Registration OCR API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared async HTTP/2 client so OCR.space calls multiplex over one kept-alive connection
+    async with httpx.AsyncClient(
+        base_url="https://api.ocr.space",
+        timeout=30,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+        )
+    ) as http:
+        app.state.http = http
+        yield
+
+# Handlers declare a `dict` return type so FastAPI serializes responses straight to JSON bytes via Pydantic
+app = FastAPI(
+    title="Vietnamese ID Card and Vehicle Registration OCR API",
+    lifespan=lifespan
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -22,15 +50,75 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OCR_SPACE_API_KEY = os.getenv("OCR_SPACE_API_KEY")
 
+# Model used for extraction (small structured task, so the mini model is enough)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+# Send images straight to the vision model instead of OCR.space + LLM
+USE_VISION_MODEL = os.getenv("USE_VISION_MODEL", "false").lower() == "true"
+
 # Check if API keys exist
-if not OPENAI_API_KEY or not OCR_SPACE_API_KEY:
+if not OPENAI_API_KEY or not (OCR_SPACE_API_KEY or USE_VISION_MODEL):
     raise Exception("Thiếu OPENAI_API_KEY hoặc OCR_SPACE_API_KEY trong biến môi trường")
 
-# Initialize OpenAI client
-openai.api_key = OPENAI_API_KEY
-client = openai
+# Initialize OpenAI client (the SDK retries 429/5xx with exponential backoff)
+client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=3)
+
+# Bound concurrent upstream calls and space out OCR.space requests
+OCR_SEM = asyncio.Semaphore(int(os.getenv("OCR_CONCURRENCY", "10")))
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "20")))
+OCR_MIN_INTERVAL = float(os.getenv("OCR_MIN_INTERVAL", "0"))
+OCR_MAX_RETRIES = 3
+# Upper bound on a server-requested Retry-After wait
+OCR_MAX_BACKOFF = 30
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+ocr_rate_lock = asyncio.Lock()
+last_ocr_call = 0.0
+
+# LRU caches of successful results, keyed on OCR text hash and on uploaded image hash
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", "1024"))
+parse_cache = OrderedDict()
+image_cache = OrderedDict()
+
+def cache_get(cache: OrderedDict, key):
+    """ Return a cached result and mark it as recently used, or None on a miss. """
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+def cache_put(cache: OrderedDict, key, result: dict):
+    """ Store a result if it succeeded so transient errors are retried, evicting the oldest entry. """
+    if not result.get("success"):
+        return
+    cache[key] = result
+    if len(cache) > PARSE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def image_cache_key(document_type: str, *images: bytes) -> tuple:
+    """ Build a cache key from the document type and a digest of each uploaded image. """
+    return (document_type,) + tuple(hashlib.blake2b(image, digest_size=16).hexdigest() for image in images)
+
+async def wait_for_ocr_slot():
+    """ Keep at least OCR_MIN_INTERVAL seconds between OCR.space requests. """
+    global last_ocr_call
+    async with ocr_rate_lock:
+        delay = last_ocr_call + OCR_MIN_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        last_ocr_call = time.monotonic()
+
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    """ Seconds to wait before retrying: Retry-After when the server sends it, else 1s, 2s, 4s. """
+    retry_after = response.headers.get("retry-after", "")
+    if retry_after.isdigit():
+        return min(int(retry_after), OCR_MAX_BACKOFF)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return min(max(retry_at.timestamp() - time.time(), 0), OCR_MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 8)
 
-def ocr_space_file(file_content: bytes, filename: str, api_key: str = OCR_SPACE_API_KEY, language: str = 'eng'):
+async def ocr_space_file(file_content: bytes, filename: str, api_key: str = OCR_SPACE_API_KEY, language: str = 'eng'):
     """ OCR.space API request with file content. """
     try:
         payload = {
@@ -41,412 +129,521 @@ def ocr_space_file(file_content: bytes, filename: str, api_key: str = OCR_SPACE_
             'scale': 'true',
             'OCREngine': 2
         }
-        files = {filename: file_content}
-        r = requests.post('https://api.ocr.space/parse/image', files=files, data=payload)
+        # Uploads are accepted on magic bytes, so send the detected type rather than trust the extension
+        mime_type = image_mime_type(file_content) or 'image/jpeg'
+        payload['filetype'] = OCR_FILE_TYPES[mime_type]
+        # A file-like body lets httpx stream the multipart upload in chunks
+        files = {'file': (filename, io.BytesIO(file_content), mime_type)}
+        for attempt in range(OCR_MAX_RETRIES + 1):
+            # Hold a slot only for the call itself so requests backing off don't starve new work
+            async with OCR_SEM:
+                await wait_for_ocr_slot()
+                r = await app.state.http.post('/parse/image', files=files, data=payload)
+            if r.status_code not in RETRY_STATUS_CODES or attempt == OCR_MAX_RETRIES:
+                break
+            delay = retry_delay(r, attempt)
+            logger.warning("OCR.space trả về %s, thử lại lần %s sau %ss", r.status_code, attempt + 1, delay)
+            await asyncio.sleep(delay)
         r.raise_for_status()
-        return r.content.decode()
-    except requests.RequestException as e:
-        logger.error(f"Lỗi khi gọi OCR.space API: {str(e)}")
+        try:
+            result = orjson.loads(r.content)
+        except orjson.JSONDecodeError:
+            result = None
+        if not isinstance(result, dict):
+            logger.error("OCR.space trả về phản hồi không hợp lệ: %s", r.text[:200])
+            raise HTTPException(status_code=500, detail="Lỗi OCR.space API: phản hồi không hợp lệ")
+        if result.get("IsErroredOnProcessing"):
+            logger.error("OCR.space không xử lý được ảnh: %s", result.get("ErrorMessage"))
+            raise HTTPException(status_code=500, detail=f"Lỗi OCR.space API: {result.get('ErrorMessage')}")
+        # Keep only the recognised text; the response envelope carries per-call timings
+        return "\n".join(page.get("ParsedText", "") for page in result.get("ParsedResults") or [])
+    except httpx.HTTPError as e:
+        logger.error("Lỗi khi gọi OCR.space API: %s", e)
         raise HTTPException(status_code=500, detail=f"Lỗi OCR.space API: {str(e)}")
 
-def fix_json_string(json_string: str) -> str:
-    """ Fix invalid JSON string (single quotes, malformed format). """
-    json_string = json_string.replace("'", '"')
-    json_string = re.sub(r'\s+', ' ', json_string.strip())
-    return json_string
+# Precompiled regex patterns used on every request
+NEWLINE_RE = re.compile(r"\s*\n\s*")
+GIOI_TINH_RE = re.compile(r"Giới tinh", re.IGNORECASE)
+# Lines starting with another card label end a multi-line value; addresses span at most four lines
+ID_CARD_LABEL = r"(?:Quê quán|Nơi (?:thường trú|cư trú|sinh|đăng ký)|Có giá trị|Ngày,? tháng|Ngày (?:sinh|cấp|hết hạn)|Đặc điểm|Place of|Date of|Personal identification)"
+ADDRESS_LINES = r"((?:(?!" + ID_CARD_LABEL + r")[^\n]+)(?:\n(?!" + ID_CARD_LABEL + r")[^\n]+){0,3})"
+QUE_QUAN_RE = re.compile(r"(Quê quán|Place of origin)\s*[:\-]?\s*\n" + ADDRESS_LINES, re.IGNORECASE)
+NOI_THUONG_TRU_RE = re.compile(r"(Nơi thường trú|Nơi cư trú|Place of residence)\s*[:\-]?\s*\n" + ADDRESS_LINES, re.IGNORECASE)
+HORIZONTAL_SPACE_RE = re.compile(r"[ \t]+")
+HEADER_RE = re.compile(
+    r"CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM\n.*?\nSOCIALIST REPUBLIC OF VIET NAM\n.*?\nCĂN CƯỚC CÔNG DÂN\n(?:.*?\n)?Citizen Identity Card",
+    re.IGNORECASE | re.DOTALL
+)
+
+# Known OCR misreadings of Vietnamese place names, fixed locally before the text reaches the LLM
+PLACE_NAME_CORRECTIONS = {
+    "Dién Biên Döng": "Điện Biên Đông",
+    "Dién Biên": "Điện Biên",
+    "Thùa Thiên Huế": "Thừa Thiên Huế",
+    "Thùa Thiên Huê": "Thừa Thiên Huế",
+    "Tp. Hô Chi Minh": "TP. Hồ Chí Minh",
+    "TP Hô Chí Minh": "TP Hồ Chí Minh",
+    "Hô Chí Minh": "Hồ Chí Minh",
+    "Hô Chi Minh": "Hồ Chí Minh",
+    "Hồ Chi Minh": "Hồ Chí Minh",
+    "Hà Nôi": "Hà Nội",
+    "Phủ Thượng": "Phú Thượng"
+}
+# Longest names first so the single-pass alternation prefers the most specific match
+PLACE_NAME_RE = re.compile(
+    r"(?<!\w)(?:" + "|".join(re.escape(name) for name in sorted(PLACE_NAME_CORRECTIONS, key=len, reverse=True)) + r")(?!\w)"
+)
+
+# Prompt building blocks per document type
+DOCUMENT_NAMES = {
+    "identity_card": "giấy tờ tùy thân Việt Nam",
+    "motorcycle": "giấy đăng ký xe máy Việt Nam",
+    "car": "giấy đăng ký xe ô tô Việt Nam",
+    "car-inspection": "giấy đăng kiểm xe ô tô Việt Nam"
+}
+
+SCHEMAS = {
+    "identity_card": '{"success":true,"document_type":"identity_card","data":{"personal_identification_number":null,"full_name":null,"date_of_birth":null,"sex":null,"nationality":"Việt Nam","place_of_residence":null,"place_of_birth":null,"date_of_issue":null,"date_of_expiry":null}}',
+    "motorcycle": '{"success":true,"document_type":"motorcycle","data":{"full_name":null,"address":null,"brand":null,"model_code":null,"engine_no":null,"chassis_no":null,"color":null,"plate_no":null}}',
+    "car": '{"success":true,"document_type":"car","data":{"address":null,"brand":null,"model_code":null,"engine_no":null,"chassis_no":null,"color":null,"plate_no":null,"seating_capacity":null,"date_of_expiry":null}}',
+    "car-inspection": '{"success":true,"document_type":"car","data":{"brand":null,"model_code":null,"engine_no":null,"chassis_no":null,"type":null,"capacity":null,"plate_no":null,"seating_capacity":null,"date_of_expiry":null}}'
+}
+
+ID_CARD_GUIDE = """-Trích xuất các trường: mã định danh (Số/No./ID), họ tên, ngày sinh, giới tính, quốc tịch, nơi thường trú, nơi sinh, ngày cấp, ngày hết hạn.
+-Gộp thông tin từ cả mặt trước và mặt sau của thẻ thành một kết quả duy nhất.
+-Nếu thẻ không ghi Nơi sinh, dùng Quê quán cho `place_of_birth`.
+-Chuẩn hóa ngày tháng từ DD/MM/YYYY hoặc DD-MM-YYYY sang YYYY-MM-DD.
+-Chuẩn hóa giới tính: "Male" → "Nam", "Female" → "Nữ".
+-Ghi địa chỉ trên một dòng, phân cách các phần bằng dấu phẩy (ví dụ: "14/20 Hoàng Diệu, Tây Lộc, Thành phố Huế, Thừa Thiên Huế").
+-Bỏ qua các dòng tiêu đề như "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM", "CĂN CƯỚC CÔNG DÂN"…
+-Sửa địa danh sai do OCR về đúng tên hành chính (ví dụ: "Phủ Thượng" → "Phú Thượng", "Dién Biên Döng" → "Điện Biên Đông").
+-Nếu thông tin không rõ ràng hoặc thiếu, để giá trị là null."""
+
+VEHICLE_GUIDE = """- Sửa lỗi OCR địa danh (ví dụ: "Hà Nôi" → "Hà Nội").
+- Lấy địa chỉ đầy đủ (xã, huyện, tỉnh) cho `address`.
+- Nếu thông tin không rõ, để null.
+- Nếu lỗi, trả về {"success":false,"error":"lý do"}."""
+
+SYSTEM_MESSAGE = "Bạn là trợ lý AI xử lý OCR giấy tờ Việt Nam, trả về JSON hợp lệ."
+
+PROMPT_TEMPLATE = """Phân tích văn bản OCR từ {document}. Sửa lỗi ký tự tiếng Việt, chuẩn hóa họ tên và địa danh, rồi trả về JSON theo định dạng:
+
+{schema}
+
+Hướng dẫn:
+{guide}"""
+
+# OCR text sent alone as the user message; ID cards carry both sides in one call
+OCR_SECTION = "Văn bản OCR:\n```\n%s\n```"
+ID_CARD_OCR_SECTION = "Văn bản OCR mặt trước:\n```\n%s\n```\n\nVăn bản OCR mặt sau:\n```\n%s\n```"
+
+# Output token ceilings sized to each schema (JSON mode stops at the closing brace)
+MAX_OUTPUT_TOKENS = {
+    "identity_card": 384,
+    "motorcycle": 256,
+    "car": 256,
+    "car-inspection": 256
+}
+
+VISION_PROMPT_TEMPLATE = """Đọc ảnh chụp {document} đính kèm. Sửa lỗi ký tự tiếng Việt, chuẩn hóa họ tên và địa danh, rồi trả về JSON theo định dạng:
+
+{schema}
+
+Hướng dẫn:
+{guide}"""
+
+ID_CARD_IMAGES_NOTE = "\n-Ảnh thứ nhất là mặt trước, ảnh thứ hai là mặt sau của thẻ."
+
+# Static system prompt per document type; it is byte-identical across calls so OpenAI caches it
+SYSTEM_PROMPTS = {
+    document_type: SYSTEM_MESSAGE + "\n\n" + PROMPT_TEMPLATE.format(
+        document=DOCUMENT_NAMES[document_type],
+        schema=SCHEMAS[document_type],
+        guide=ID_CARD_GUIDE if document_type == "identity_card" else VEHICLE_GUIDE
+    )
+    for document_type in SCHEMAS
+}
+
+# User message per document type with %s placeholders for the OCR text
+USER_TEMPLATES = {
+    document_type: ID_CARD_OCR_SECTION if document_type == "identity_card" else OCR_SECTION
+    for document_type in SCHEMAS
+}
+
+# System prompt per document type for the vision path (images are sent as the user message)
+VISION_SYSTEM_PROMPTS = {
+    document_type: SYSTEM_MESSAGE + "\n\n" + VISION_PROMPT_TEMPLATE.format(
+        document=DOCUMENT_NAMES[document_type],
+        schema=SCHEMAS[document_type],
+        guide=ID_CARD_GUIDE + ID_CARD_IMAGES_NOTE if document_type == "identity_card" else VEHICLE_GUIDE
+    )
+    for document_type in SCHEMAS
+}
+
+def join_lines(m: re.Match) -> str:
+    """ Join a label with its multi-line value into one comma-separated line. """
+    return "{}: {}".format(m.group(1), ", ".join(line.strip(" ,") for line in m.group(2).split("\n")))
+
+def correct_place_names(ocr_text: str) -> str:
+    """ Replace known misspelled place names in one pass over the text. """
+    return PLACE_NAME_RE.sub(lambda m: PLACE_NAME_CORRECTIONS[m.group(0)], ocr_text)
 
 def preprocess_ocr_text(ocr_text: str) -> str:
     """Tiền xử lý văn bản OCR, tập trung vào gộp Place of origin và Place of residence."""
     # Chuẩn hóa khoảng trắng và xuống dòng
-    ocr_text = re.sub(r"\s*\n\s*", "\n", ocr_text.strip())
+    ocr_text = NEWLINE_RE.sub("\n", ocr_text.strip())
     
     # Sửa lỗi nhãn "Giới tinh" thành "Giới tính"
-    ocr_text = re.sub(r"Giới tinh", "Giới tính", ocr_text, flags=re.IGNORECASE)
+    ocr_text = GIOI_TINH_RE.sub("Giới tính", ocr_text)
     
     # Gộp "Quê quán" hoặc "Place of origin" với nội dung bị tách dòng
-    ocr_text = re.sub(
-        r"(Quê quán|Place of origin)\s*[:\-]?\s*\n([^\n]+(?:\n[^\n]+)*)",
-        lambda m: "{}: {}".format(m.group(1), re.sub(r"\n", ", ", m.group(2).strip())),
-        ocr_text,
-        flags=re.IGNORECASE
-    )
+    ocr_text = QUE_QUAN_RE.sub(join_lines, ocr_text)
     
     # Gộp "Nơi thường trú" hoặc "Place of residence" với nội dung bị tách dòng
-    ocr_text = re.sub(
-        r"(Nơi thường trú|Place of residence)\s*[:\-]?\s*\n([^\n]+(?:\n[^\n]+)*)",
-        lambda m: "{}: {}".format(m.group(1), re.sub(r"\n", ", ", m.group(2).strip())),
-        ocr_text,
-        flags=re.IGNORECASE
-    )
+    ocr_text = NOI_THUONG_TRU_RE.sub(join_lines, ocr_text)
     
     # Loại bỏ các dòng tiêu đề không cần thiết
-    ocr_text = re.sub(
-        r"CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM\n.*?\nSOCIALIST REPUBLIC OF VIET NAM\n.*?\nCĂN CƯỚC CÔNG DÂN\n.*?\nCitizen Identity Card",
-        "",
-        ocr_text,
-        flags=re.IGNORECASE | re.DOTALL
-    )
+    ocr_text = HEADER_RE.sub("", ocr_text)
     
     return ocr_text.strip()
-def parse_ocr_to_json(ocr_text: str, document_type: str = "identity_card") -> dict:
-    """ Parse OCR text into JSON for Vietnamese documents. """
+
+async def parse_ocr_to_json(ocr_text: str, document_type: str) -> dict:
+    """ Parse OCR text of a single-sided document into JSON. """
     if document_type == "identity_card":
-        ocr_text = preprocess_ocr_text(ocr_text)
-
-        prompt = f"""
-        Phân tích văn bản OCR từ giấy tờ tùy thân Việt Nam. **Sửa lỗi ký tự tiếng Việt và chuẩn hóa họ tên và địa danh về đúng tên hành chính Việt Nam**. Sau đó trích xuất các thông tin vào JSON theo định dạng sau:
-
-        ```json
-        {{
-          "success": true,
-          "document_type": "identity_card",
-          "data": {{
-            "personal_identification_number": null,
-            "full_name": null,
-            "date_of_birth": null,
-            "sex": null,
-            "nationality": "Việt Nam",
-            "place_of_residence": null,
-            "place_of_birth": null,
-            "place_of_origin": null,
-            "date_of_issue": null,
-            "date_of_expiry": null
-          }}
-        }}
-        ```
-
-        Văn bản OCR:
-        ```
-        {ocr_text}
-        ```
-
-        Hướng dẫn:
-        -Trích xuất các trường: mã định danh (Số/No./ID), họ tên, ngày sinh, giới tính, quốc tịch, nơi thường trú, nơi sinh, quê quán, ngày cấp, ngày hết hạn.
-        -Chuẩn hóa ngày tháng từ DD/MM/YYYY hoặc DD-MM-YYYY sang YYYY-MM-DD.
-        -Chuẩn hóa giới tính: "Male" → "Nam", "Female" → "Nữ".
-        -Địa chỉ như Quê quán hoặc Nơi thường trú đã được gộp thành một dòng, chứa dấu phẩy giữa các phần (ví dụ: "14/20 Hoàng Diệu, Tây Lộc, Thành phố Huế, Thừa Thiên Huế").
-        -Bỏ qua các dòng tiêu đề như "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM", "CĂN CƯỚC CÔNG DÂN"…
-        -Nếu phát hiện tên địa danh sai do OCR (ví dụ: "Phủ Thượng"), hãy tự động sửa về đúng tên hành chính thực tế ("Phú Thượng").
-        -Có thể sử dụng kiến thức về địa danh Việt Nam để sửa lỗi như: "Dién Biên Döng" → "Điện Biên Đông", "Thùa Thiên Huế" → "Thừa Thiên Huế", "Tp. Hô Chi Minh" → "TP. Hồ Chí Minh"...
-        -Nếu thông tin không rõ ràng hoặc thiếu, để giá trị là null.
-        -Chỉ trả về JSON hợp lệ, không thêm bất kỳ văn bản mô tả nào khác.
-        """
-    elif document_type == "motorcycle":
-        prompt = f"""
-        Phân tích văn bản OCR từ giấy đăng ký xe máy Việt Nam, **Sửa lỗi ký tự tiếng Việt và chuẩn hóa  họ tên và địa danh về đúng tên hành chính Việt Nam**, trả về JSON hợp lệ:
-
-        ```json
-        {{
-          "success": true,
-          "document_type": "motorcycle",
-          "data": {{
-            "full_name": null,
-            "address": null,
-            "brand": null,
-            "model_code": null,
-            "engine_no": null,
-            "chassis_no": null,
-            "color": null,
-            "plate_no": null
-          }}
-        }}
-        ```
-
-        Văn bản OCR:
-        ```
-        {ocr_text}
-        ```
-
-        Hướng dẫn:
-        - Sửa lỗi OCR (ví dụ: "Hà Nôi" → "Hà Nội", "TP Hô Chí Minh" → "TP Hồ Chí Minh") dựa trên địa danh Việt Nam.
-        - Lấy địa chỉ đầy đủ (xã, huyện, tỉnh) cho `address`.
-        - Nếu thông tin không rõ, để null.
-        - Trả về JSON trong khối ```json ... ```, dùng dấu nháy kép cho chuỗi.
-        - Nếu lỗi, trả về {{"success": false, "error": "lý do"}}.
-        """
-    elif document_type == "car":
-        prompt = f"""
-        Phân tích văn bản OCR từ giấy đăng ký xe ô tô Việt Nam, **Sửa lỗi ký tự tiếng Việt và chuẩn hóa  họ tên và  địa danh về đúng tên hành chính Việt Nam**, trả về JSON hợp lệ:
-
-        ```json
-        {{
-          "success": true,
-          "document_type": "car",
-          "data": {{
-            "address": null,
-            "brand": null,
-            "model_code": null,
-            "engine_no": null,
-            "chassis_no": null,
-            "color": null,
-            "plate_no": null,
-            "seating_capacity": null,
-            "date_of_expiry": null
-          }}
-        }}
-        ```
-
-        Văn bản OCR:
-        ```
-        {ocr_text}
-        ```
-
-        Hướng dẫn:
-        - Sửa lỗi OCR (ví dụ: "Hà Nôi" → "Hà Nội", "TP Hô Chí Minh" → "TP Hồ Chí Minh") dựa trên địa danh Việt Nam.
-        - Lấy địa chỉ đầy đủ (xã, huyện, tỉnh) cho `address`.
-        - Nếu thông tin không rõ, để null.
-        - Trả về JSON trong khối ```json ... ```, dùng dấu nháy kép cho chuỗi.
-        - Nếu lỗi, trả về {{"success": false, "error": "lý do"}}.
-        """
-    elif document_type == "car-inspection":
-        prompt = f"""
-        Phân tích văn bản OCR từ giấy đăng kiểm xe ô tô Việt Nam, **Sửa lỗi ký tự tiếng Việt và chuẩn hóa  họ tên và  địa danh về đúng tên hành chính Việt Nam**, trả về JSON hợp lệ:
-
-        ```json
-        {{
-          "success": true,
-          "document_type": "car",
-          "data": {{
-            "brand": null,
-            "model_code": null,
-            "engine_no": null,
-            "chassis_no": null,
-            "type": null,
-            "capacity": null,
-            "plate_no": null,
-            "seating_capacity": null,
-            "date_of_expiry": null
-          }}
-        }}
-        ```
-
-        Văn bản OCR:
-        ```
-        {ocr_text}
-        ```
-
-        Hướng dẫn:
-        - Sửa lỗi OCR (ví dụ: "Hà Nôi" → "Hà Nội", "TP Hô Chí Minh" → "TP Hồ Chí Minh") dựa trên địa danh Việt Nam.
-        - Lấy địa chỉ đầy đủ (xã, huyện, tỉnh) cho `address`.
-        - Nếu thông tin không rõ, để null.
-        - Trả về JSON trong khối ```json ... ```, dùng dấu nháy kép cho chuỗi.
-        - Nếu lỗi, trả về {{"success": false, "error": "lý do"}}.
-        """
+        return {"success": False, "error": "Căn cước cần OCR của cả hai mặt, dùng parse_id_card_pair"}
+    return await parse_cached([ocr_text], document_type)
+
+async def parse_id_card_pair(front_ocr: str, back_ocr: str) -> dict:
+    """ Parse front and back ID card OCR text into one merged JSON with a single OpenAI call. """
+    return await parse_cached([front_ocr, back_ocr], "identity_card")
+
+def prepare_ocr_texts(ocr_texts: list, document_type: str) -> list:
+    """ Clean OCR text into the exact form sent to OpenAI. """
+    # Collapse runs of spaces and tabs; line breaks are kept because preprocessing relies on them
+    ocr_texts = [HORIZONTAL_SPACE_RE.sub(" ", text).strip() for text in ocr_texts]
+    if document_type == "identity_card":
+        ocr_texts = [preprocess_ocr_text(text) for text in ocr_texts]
+    return [correct_place_names(text) for text in ocr_texts]
+
+async def parse_cached(ocr_texts: list, document_type: str) -> dict:
+    """ Parse OCR text into JSON, reusing cached results for identical cleaned OCR text. """
+    # Key on the text actually sent, so re-scans that clean up the same way share one parse
+    ocr_texts = prepare_ocr_texts(ocr_texts, document_type)
+    digest = hashlib.blake2b("\x00".join(ocr_texts).encode(), digest_size=16).hexdigest()
+    key = (document_type, digest)
+    cached = cache_get(parse_cache, key)
+    if cached is not None:
+        logger.info("Dùng kết quả phân tích đã lưu trong cache")
+        return cached
+
+    result = await call_openai_parser(ocr_texts, document_type)
+    cache_put(parse_cache, key, result)
+    return result
+
+async def call_openai_parser(ocr_texts: list, document_type: str) -> dict:
+    """ Parse cleaned OCR text (see prepare_ocr_texts) into JSON for Vietnamese documents. """
+    if document_type not in SYSTEM_PROMPTS:
+        return {"success": False, "error": f"Loại giấy tờ không được hỗ trợ: {document_type}"}
+    if len(ocr_texts) != USER_TEMPLATES[document_type].count("%s"):
+        return {"success": False, "error": f"Số văn bản OCR không khớp với loại giấy tờ: {document_type}"}
+    if not any(text.strip() for text in ocr_texts):
+        logger.warning("Không tìm thấy văn bản trong hình ảnh")
+        return {"success": False, "error": "Không tìm thấy văn bản trong hình ảnh"}
+    # Only the user message varies per call; the system prompt is built once at import
+    user_content = USER_TEMPLATES[document_type] % tuple(ocr_texts)
+    return await request_json(SYSTEM_PROMPTS[document_type], user_content, document_type)
+
+def image_message_parts(images: list) -> list:
+    """ Encode images as base64 data-URL parts of a chat message. """
+    parts = []
+    for image in images:
+        mime_type = image_mime_type(image) or "image/jpeg"
+        encoded = base64.b64encode(image).decode()
+        parts.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded}"}})
+    return parts
+
+async def parse_images_to_json(images: list, document_type: str = "identity_card") -> dict:
+    """ Extract JSON directly from document images with the vision model, skipping OCR.space. """
+    if document_type not in VISION_SYSTEM_PROMPTS:
+        return {"success": False, "error": f"Loại giấy tờ không được hỗ trợ: {document_type}"}
+    # Base64-encoding megabytes of image data is CPU work; keep it off the event loop
+    content = await run_in_threadpool(image_message_parts, images)
+    return await request_json(VISION_SYSTEM_PROMPTS[document_type], content, document_type)
+
+async def request_json(system_prompt: str, user_content, document_type: str) -> dict:
+    """ Send the static system prompt plus user content (text or images) to OpenAI and decode the JSON reply. """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Bạn là trợ lý AI xử lý OCR giấy tờ Việt Nam, trả về JSON hợp lệ."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500,
-            temperature=0.2
-        )
-        response_text = response.choices[0].message.content.strip()
-        json_match = re.search(r'```json\n(.*?)\n```', response_text, re.DOTALL)
-        if not json_match:
-            logger.error("Không tìm thấy khối JSON trong phản hồi từ OpenAI")
-            return {"success": False, "error": "Không tìm thấy khối JSON trong phản hồi"}
-        json_string = json_match.group(1).strip()
-        json_string = fix_json_string(json_string)
+        async with OPENAI_SEM:
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_content}
+                ],
+                max_tokens=MAX_OUTPUT_TOKENS[document_type],
+                temperature=0,
+                response_format={"type": "json_object"},
+                # Stable routing key so the static prompt prefix hits OpenAI's prompt cache
+                extra_body={"prompt_cache_key": f"idocr::{document_type}::v1"}
+            )
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            logger.error("Phản hồi từ OpenAI bị cắt do vượt giới hạn token")
+            return {"success": False, "error": "Phản hồi bị cắt do vượt giới hạn token"}
         try:
-            json_output = json.loads(json_string)
-            return json_output
-        except json.JSONDecodeError as e:
-            logger.error(f"Định dạng JSON không hợp lệ: {str(e)}")
+            # JSON mode guarantees strict JSON, so no string repair is needed
+            json_output = orjson.loads(choice.message.content)
+        except orjson.JSONDecodeError as e:
+            logger.error("Định dạng JSON không hợp lệ: %s", e)
             return {"success": False, "error": f"Định dạng JSON không hợp lệ: {str(e)}"}
+        if not isinstance(json_output, dict) or "success" not in json_output or (
+            json_output["success"] and not isinstance(json_output.get("data"), dict)
+        ):
+            logger.error("Phản hồi JSON thiếu trường bắt buộc")
+            return {"success": False, "error": "Phản hồi JSON thiếu trường bắt buộc"}
+        return json_output
     except Exception as e:
-        logger.error(f"Lỗi khi gọi OpenAI API: {str(e)}")
+        logger.error("Lỗi khi gọi OpenAI API: %s", e)
         return {"success": False, "error": f"Lỗi API: {str(e)}"}
 
-def merge_ocr_results(front_result: dict, back_result: dict) -> dict:
-    """ Merge OCR results from front and back images. """
-    if not front_result.get("success") or not back_result.get("success"):
-        logger.error("Một hoặc cả hai quá trình OCR thất bại")
-        return {"success": False, "error": "Một hoặc cả hai quá trình OCR thất bại"}
-    
-    merged_data = {
-        "success": True,
-        "document_type": "identity_card",
-        "data": {
-            "personal_identification_number": front_result["data"].get("personal_identification_number"),
-            "full_name": front_result["data"].get("full_name"),
-            "date_of_birth": front_result["data"].get("date_of_birth"),
-            "sex": front_result["data"].get("sex"),
-            "nationality": front_result["data"].get("nationality", "Việt Nam"),
-            "place_of_residence": front_result["data"].get("place_of_residence") or back_result["data"].get("place_of_residence"),
-            "place_of_birth": back_result["data"].get("place_of_birth") or front_result["data"].get("place_of_origin"),
-            "date_of_issue": back_result["data"].get("date_of_issue"),
-            "date_of_expiry": back_result["data"].get("date_of_expiry") or front_result["data"].get("date_of_expiry")
-        }
-    }
-    return merged_data
+# Phone photos are far larger than OCR needs; cap the long edge before upload
+MAX_IMAGE_EDGE = 1600
+JPEG_QUALITY = 85
+# Images declaring more pixels than this are forwarded untouched rather than decoded
+MAX_IMAGE_PIXELS = 50_000_000
+
+def downscale_image(content: bytes, filename: str) -> tuple:
+    """ Shrink an image to MAX_IMAGE_EDGE on its long side and recompress it as JPEG. """
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            if max(img.size) <= MAX_IMAGE_EDGE:
+                return content, filename
+            # The header alone gives the size; refuse to decode decompression bombs
+            if img.size[0] * img.size[1] > MAX_IMAGE_PIXELS:
+                logger.warning("Ảnh %s quá nhiều điểm ảnh để thu nhỏ: %sx%s", filename, *img.size)
+                return content, filename
+            # Let JPEG decode at a reduced DCT scale, then rotate the small image (bounds are square)
+            img.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            img = ImageOps.exif_transpose(img)
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    except (OSError, Image.DecompressionBombError) as e:
+        # Let OCR decide on images Pillow cannot decode
+        logger.warning("Không thể thu nhỏ ảnh %s: %s", filename, e)
+        return content, filename
+    resized = buf.getvalue()
+    if len(resized) >= len(content):
+        return content, filename
+    return resized, os.path.splitext(filename)[0] + ".jpg"
+
+async def extract_id_card(front_content: bytes, back_content: bytes, front_name: str, back_name: str) -> dict:
+    """ Run both ID card images through the configured extraction pipeline. """
+    # Identical uploads skip OCR and OpenAI entirely (hashing up to 10MB runs off the event loop)
+    key = await run_in_threadpool(image_cache_key, "identity_card", front_content, back_content)
+    cached = cache_get(image_cache, key)
+    if cached is not None:
+        logger.info("Dùng kết quả đã lưu trong cache cho hình ảnh")
+        return cached
+
+    # Shrink both photos off the event loop before uploading them
+    (front_content, front_name), (back_content, back_name) = await asyncio.gather(
+        run_in_threadpool(downscale_image, front_content, front_name),
+        run_in_threadpool(downscale_image, back_content, back_name)
+    )
+
+    if USE_VISION_MODEL:
+        # One vision call reads both sides of the card
+        result = await parse_images_to_json([front_content, back_content], document_type="identity_card")
+    else:
+        # Process OCR for both images concurrently, then parse both sides in a single OpenAI call
+        front_ocr, back_ocr = await asyncio.gather(
+            ocr_space_file(front_content, front_name),
+            ocr_space_file(back_content, back_name)
+        )
+        result = await parse_id_card_pair(front_ocr, back_ocr)
+    cache_put(image_cache, key, result)
+    return result
+
+async def extract_document(content: bytes, filename: str, document_type: str) -> dict:
+    """ Run one document image through the configured extraction pipeline. """
+    key = await run_in_threadpool(image_cache_key, document_type, content)
+    cached = cache_get(image_cache, key)
+    if cached is not None:
+        logger.info("Dùng kết quả đã lưu trong cache cho hình ảnh")
+        return cached
+
+    content, filename = await run_in_threadpool(downscale_image, content, filename)
+    if USE_VISION_MODEL:
+        result = await parse_images_to_json([content], document_type=document_type)
+    else:
+        ocr_result = await ocr_space_file(content, filename)
+        result = await parse_ocr_to_json(ocr_result, document_type=document_type)
+    cache_put(image_cache, key, result)
+    return result
+
+# File signatures of the accepted image formats
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png"
+}
+# OCR.space guesses the type from the file extension unless `filetype` is given
+OCR_FILE_TYPES = {
+    "image/jpeg": "JPG",
+    "image/png": "PNG"
+}
+MAX_FILE_SIZE = 5_000_000
+# Two images at the file limit plus room for multipart headers
+MAX_REQUEST_SIZE = 2 * MAX_FILE_SIZE + 64 * 1024
+
+def image_mime_type(content: bytes):
+    """ Return the MIME type for JPG/PNG content from its magic bytes, or None. """
+    for signature, mime_type in IMAGE_SIGNATURES.items():
+        if content.startswith(signature):
+            return mime_type
+    return None
+
+def validate_image(content: bytes, filename: str):
+    """ Reject uploads whose content is not a JPG or PNG image. """
+    if not content:
+        logger.warning("File rỗng: %s", filename)
+        raise HTTPException(status_code=400, detail="File tải lên bị rỗng")
+    if image_mime_type(content) is None:
+        logger.warning("Định dạng file không hợp lệ: %s", filename)
+        raise HTTPException(status_code=400, detail="Chỉ chấp nhận file JPG hoặc PNG")
+
+async def read_upload(upload: UploadFile, limit: int = MAX_FILE_SIZE) -> bytes:
+    """ Read an upload with one bounded read, rejecting it if it exceeds the size limit. """
+    # Starlette has already spooled the part; reading one byte past the limit detects oversize files
+    content = await upload.read(limit + 1)
+    if len(content) > limit:
+        logger.warning("Kích thước file vượt quá 5MB")
+        raise HTTPException(status_code=413, detail="Kích thước file vượt quá 5MB")
+    return content
+
+class RequestSizeLimitMiddleware:
+    """ Reject oversized bodies before the multipart parser buffers them. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Plain ASGI middleware: no task group or stream wrapping around every request
+        if scope["type"] == "http":
+            content_length = dict(scope["headers"]).get(b"content-length")
+            if content_length is None:
+                # Chunked bodies carry no length up front, so count bytes as the app reads them
+                receive = self.limit_body(receive)
+            elif content_length.isdigit() and int(content_length) > MAX_REQUEST_SIZE:
+                logger.warning("Kích thước yêu cầu vượt quá giới hạn: %s", content_length.decode())
+                response = JSONResponse(status_code=413, content={"detail": "Kích thước file vượt quá 5MB"})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def limit_body(receive):
+        """ Wrap receive so the request fails with 413 once the body passes MAX_REQUEST_SIZE. """
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_REQUEST_SIZE:
+                    logger.warning("Kích thước yêu cầu vượt quá giới hạn: %s", received)
+                    raise HTTPException(status_code=413, detail="Kích thước file vượt quá 5MB")
+            return message
+
+        return limited_receive
+
+app.add_middleware(RequestSizeLimitMiddleware)
 
 @app.post("/process-id-card/")
 async def process_id_card(
     front_image: UploadFile = File(...),
     back_image: UploadFile = File(...)
-):
+) -> dict:
     """ Process uploaded front and back ID card images and return extracted information as JSON. """
-    # Validate file types
-    allowed_extensions = {'.jpg', '.jpeg', '.png'}
-    front_ext = os.path.splitext(front_image.filename)[1].lower()
-    back_ext = os.path.splitext(back_image.filename)[1].lower()
-    
-    if front_ext not in allowed_extensions or back_ext not in allowed_extensions:
-        logger.warning(f"Định dạng file không hợp lệ: front={front_ext}, back={back_ext}")
-        raise HTTPException(status_code=400, detail="Chỉ chấp nhận file JPG hoặc PNG")
-
-    # Validate file size (5MB limit)
-    if front_image.size > 5_000_000 or back_image.size > 5_000_000:
-        logger.warning("Kích thước file vượt quá 5MB")
-        raise HTTPException(status_code=400, detail="Kích thước file vượt quá 5MB")
+    front_content = await read_upload(front_image)
+    back_content = await read_upload(back_image)
+    validate_image(front_content, front_image.filename)
+    validate_image(back_content, back_image.filename)
+    # The same photo for both sides is a client mistake; reject it before any OCR call
+    if front_content == back_content:
+        logger.warning("Ảnh mặt trước và mặt sau giống hệt nhau")
+        raise HTTPException(status_code=400, detail="Ảnh mặt trước và mặt sau giống hệt nhau")
 
     try:
-        # Read file content into memory
-        front_content = await front_image.read()
-        back_content = await back_image.read()
-
-        # Process OCR for both images concurrently using ThreadPoolExecutor
         logger.info("Bắt đầu xử lý OCR cho hình ảnh")
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            loop = asyncio.get_event_loop()
-            front_task = loop.run_in_executor(executor, ocr_space_file, front_content, front_image.filename)
-            back_task = loop.run_in_executor(executor, ocr_space_file, back_content, back_image.filename)
-            front_ocr, back_ocr = await asyncio.gather(front_task, back_task)
-        
-        front_result = parse_ocr_to_json(front_ocr, document_type="identity_card")
-        back_result = parse_ocr_to_json(back_ocr, document_type="identity_card")
-
-        # Merge results
-        final_result = merge_ocr_results(front_result, back_result)
+        final_result = await extract_id_card(front_content, back_content, front_image.filename, back_image.filename)
         logger.info("Hoàn thành xử lý OCR và gộp kết quả")
         
         return final_result
 
     except Exception as e:
-        logger.error(f"Lỗi khi xử lý hình ảnh: {str(e)}")
+        logger.error("Lỗi khi xử lý hình ảnh: %s", e)
         raise HTTPException(status_code=500, detail=f"Lỗi khi xử lý hình ảnh: {str(e)}")
 
 @app.post("/process-motobike-registration/")
-async def process_vehicle_registration(
+async def process_motorbike_registration(
     image: UploadFile = File(...)
-):
+) -> dict:
     """ Process uploaded vehicle registration image and return extracted information as JSON. """
-    # Validate file type
-    allowed_extensions = {'.jpg', '.jpeg', '.png'}
-    ext = os.path.splitext(image.filename)[1].lower()
-    
-    if ext not in allowed_extensions:
-        logger.warning(f"Định dạng file không hợp lệ: {ext}")
-        raise HTTPException(status_code=400, detail="Chỉ chấp nhận file JPG hoặc PNG")
-
-    # Validate file size (5MB limit)
-    if image.size > 5_000_000:
-        logger.warning("Kích thước file vượt quá 5MB")
-        raise HTTPException(status_code=400, detail="Kích thước file vượt quá 5MB")
+    content = await read_upload(image)
+    validate_image(content, image.filename)
 
     try:
-        # Read file content into memory
-        content = await image.read()
-
-        # Process OCR for the image
         logger.info("Bắt đầu xử lý OCR cho giấy đăng ký xe máy")
-        ocr_result = await asyncio.get_event_loop().run_in_executor(
-            ThreadPoolExecutor(max_workers=1), 
-            ocr_space_file, 
-            content, 
-            image.filename
-        )
-        
-        # Parse OCR result
-        result = parse_ocr_to_json(ocr_result, document_type="motorcycle")
+        result = await extract_document(content, image.filename, document_type="motorcycle")
         logger.info("Hoàn thành xử lý OCR cho giấy đăng ký xe máy")
         
         return result
 
     except Exception as e:
-        logger.error(f"Lỗi khi xử lý hình ảnh giấy đăng ký xe máy: {str(e)}")
+        logger.error("Lỗi khi xử lý hình ảnh giấy đăng ký xe máy: %s", e)
         raise HTTPException(status_code=500, detail=f"Lỗi khi xử lý hình ảnh: {str(e)}")
     
 @app.post("/process-car-registration/")
-async def process_vehicle_registration(
+async def process_car_registration(
     image: UploadFile = File(...)
-):
+) -> dict:
     """ Process uploaded vehicle registration image and return extracted information as JSON. """
-    # Validate file type
-    allowed_extensions = {'.jpg', '.jpeg', '.png'}
-    ext = os.path.splitext(image.filename)[1].lower()
-    
-    if ext not in allowed_extensions:
-        logger.warning(f"Định dạng file không hợp lệ: {ext}")
-        raise HTTPException(status_code=400, detail="Chỉ chấp nhận file JPG hoặc PNG")
-
-    # Validate file size (5MB limit)
-    if image.size > 5_000_000:
-        logger.warning("Kích thước file vượt quá 5MB")
-        raise HTTPException(status_code=400, detail="Kích thước file vượt quá 5MB")
+    content = await read_upload(image)
+    validate_image(content, image.filename)
 
     try:
-        # Read file content into memory
-        content = await image.read()
-
-        # Process OCR for the image
         logger.info("Bắt đầu xử lý OCR cho giấy đăng ký ô tô")
-        ocr_result = await asyncio.get_event_loop().run_in_executor(
-            ThreadPoolExecutor(max_workers=1), 
-            ocr_space_file, 
-            content, 
-            image.filename
-        )
-        
-        # Parse OCR result
-        result = parse_ocr_to_json(ocr_result, document_type="car")
+        result = await extract_document(content, image.filename, document_type="car")
         logger.info("Hoàn thành xử lý OCR cho giấy đăng ký ô tô")
         
         return result
 
     except Exception as e:
-        logger.error(f"Lỗi khi xử lý hình ảnh giấy đăng ký ô tô: {str(e)}")
+        logger.error("Lỗi khi xử lý hình ảnh giấy đăng ký ô tô: %s", e)
         raise HTTPException(status_code=500, detail=f"Lỗi khi xử lý hình ảnh: {str(e)}")
     
 @app.post("/process-car-inspection/")
-async def process_vehicle_registration(
+async def process_car_inspection(
     image: UploadFile = File(...)
-):
+) -> dict:
     """ Process uploaded vehicle inspection image and return extracted information as JSON. """
-    # Validate file type
-    allowed_extensions = {'.jpg', '.jpeg', '.png'}
-    ext = os.path.splitext(image.filename)[1].lower()
-    
-    if ext not in allowed_extensions:
-        logger.warning(f"Định dạng file không hợp lệ: {ext}")
-        raise HTTPException(status_code=400, detail="Chỉ chấp nhận file JPG hoặc PNG")
-
-    # Validate file size (5MB limit)
-    if image.size > 5_000_000:
-        logger.warning("Kích thước file vượt quá 5MB")
-        raise HTTPException(status_code=400, detail="Kích thước file vượt quá 5MB")
+    content = await read_upload(image)
+    validate_image(content, image.filename)
 
     try:
-        # Read file content into memory
-        content = await image.read()
-
-        # Process OCR for the image
         logger.info("Bắt đầu xử lý OCR cho giấy đăng kiểm ô tô")
-        ocr_result = await asyncio.get_event_loop().run_in_executor(
-            ThreadPoolExecutor(max_workers=1), 
-            ocr_space_file, 
-            content, 
-            image.filename
-        )
-        
-        # Parse OCR result
-        result = parse_ocr_to_json(ocr_result, document_type="car-inspection")
+        result = await extract_document(content, image.filename, document_type="car-inspection")
         logger.info("Hoàn thành xử lý OCR cho giấy đăng kiểm ô tô")
         
         return result
 
     except Exception as e:
-        logger.error(f"Lỗi khi xử lý hình ảnh giấy đăng kiểm ô tô: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Lỗi khi xử lý hình ảnh: {str(e)}")
\ No newline at end of file
+        logger.error("Lỗi khi xử lý hình ảnh giấy đăng kiểm ô tô: %s", e)
+        raise HTTPException(status_code=500, detail=f"Lỗi khi xử lý hình ảnh: {str(e)}")
+
+if __name__ == "__main__":
+    import uvicorn
+    # "auto" picks uvloop and httptools whenever they are installed and falls back to asyncio/h11 otherwise
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), loop="auto", http="auto")